@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 import asyncio
 import aioserial
+import concurrent.futures
 import functools
+import json
 import mido
 import os
+import queue
+import re
 import sys
-import tomli_w
+import threading
 import tomllib
 from enum import Enum, IntEnum
 
-print = functools.partial(print, flush=True)
+# Keep output timely when not attached to a terminal (e.g. in a container)
+sys.stdout.reconfigure(line_buffering=True)
+
+DEBUG = bool(os.environ.get('CONTROL_PANEL_DEBUG'))
 
 COLUMNS = 16
 ROWS = 2
@@ -24,11 +31,23 @@ display_outport = None
 reg_inport = None
 reg_outport = None
 
-tty_queue = asyncio.Queue()
-
-selected_stops = set()
-active_stops = set()
+# Bounded so a stalled consumer pushes back on the readers instead of
+# buffering input without limit
+tty_queue = asyncio.Queue(maxsize=64)
+midi_in_queue = asyncio.Queue()
+midi_out_queue = queue.Queue()
+display_write_queue = asyncio.Queue()
+display_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+settings_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+displayed_frame = None
+
+# Stop sets are bitmasks, with bit n set when MIDI note n is in the set
+selected_stops = 0
+active_stops = 0
+stops_dirty = False
 stops_channel = 0
+stop_on_messages = []
+stop_off_messages = []
 
 piston = None
 manual_piston = None
@@ -36,8 +55,21 @@ reed_cutoff = False
 
 piston_settings = {}
 
+loading = False
+
 
 
+SYSEX_PREFIX = b'JOHANNUSANTONIJN'
+HEX_DIGITS = b'0123456789abcdef'
+
+def hex4(value):
+    return bytes((
+        HEX_DIGITS[(value >> 12) & 0xf],
+        HEX_DIGITS[(value >> 8) & 0xf],
+        HEX_DIGITS[(value >> 4) & 0xf],
+        HEX_DIGITS[value & 0xf],
+    ))
+
 class AntonijnSysexEvent(IntEnum):
     TRANSPOSE = 0x01
     TEMPERAMENT = 0x02
@@ -55,57 +87,153 @@ class AntonijnSysexEvent(IntEnum):
     GRANDORGUE_START_METRONOME = 0x143
     GRANDORGUE_STOP_METRONOME = 0x144
 
+    @functools.cache
     def midi_message(self, value):
-        if value < 0:
-            value = 0x10000 + value
-        s = f'JOHANNUSANTONIJN{self.value:04x}{value:04x}'
-        return mido.Message('sysex', data=s.encode())
+        # Negative values are sent as 16-bit two's complement
+        data = SYSEX_PREFIX + hex4(self.value) + hex4(value & 0xffff)
+        return mido.Message('sysex', data=data)
+
+ready_data = tuple(AntonijnSysexEvent.GRANDORGUE_READY.midi_message(0).data)
 
+LEFT_ARROW = b'< '
+NO_LEFT_ARROW = b'  '
+RIGHT_ARROW = b' >'
+
+def encode_text(text):
+    return text.encode('ascii', 'replace')
+
+@functools.lru_cache(maxsize=256)
 def format_arrows(text, left=True, right=True):
     text_width = COLUMNS - 2
     if right:
         text_width -= 2
 
     # Truncate
-    text = text[:text_width]
+    text = encode_text(text)[:text_width]
 
     if right:
         # Only pad when there is a right arrow
-        text = f'{text:{text_width}} >'
+        text = text.ljust(text_width) + RIGHT_ARROW
 
-    return ('< ' if left else '  ') + text
+    return (LEFT_ARROW if left else NO_LEFT_ARROW) + text
 
-def display_outport_writeln(text):
-    data = (text[:COLUMNS] + '\n').encode('utf-8')
-    display_outport.write(data)
+def format_frame(line1, line2):
+    return line1[:COLUMNS] + b'\n' + line2[:COLUMNS] + b'\n'
 
-def wait_for_ready():
-    display_outport_writeln('Laden...')
-    display_outport_writeln('')
+def display_write_frame(frame):
+    global displayed_frame
+    # Skip frames that are already on the display
+    if frame != displayed_frame:
+        display_write_queue.put_nowait(frame)
+        displayed_frame = frame
 
-    # Wait for ready event
-    ready_msg = AntonijnSysexEvent.GRANDORGUE_READY.midi_message(0)
+async def write_display():
+    loop = asyncio.get_running_loop()
     while True:
-        msg = mdevice.receive()
-        if msg.type == 'sysex' and msg.data == ready_msg.data:
-            break
+        data = await display_write_queue.get()
+        # Every item is a full frame, so only the newest one matters
+        while not display_write_queue.empty():
+            data = display_write_queue.get_nowait()
+        await loop.run_in_executor(display_writer, display_outport.write, data)
+
+def stop_on_failure(task):
+    # Background task errors should bring the panel down (and have it
+    # restarted), like they did when everything ran inside main()
+    if not task.cancelled() and task.exception() is not None:
+        print('Task failed:', repr(task.exception()))
+        task.get_loop().stop()
+
+async def wait_for_ready():
+    global loading
+    loading = True
+    try:
+        display_write_frame(format_frame(b'Laden...', b''))
+
+        # Drop anything left over, such as a READY from an earlier load
+        while not midi_in_queue.empty():
+            midi_in_queue.get_nowait()
+
+        # Wait for ready event
+        while True:
+            msg = await midi_in_queue.get()
+            if msg.type == 'sysex' and msg.data == ready_data:
+                break
 
-    # We ignore any key presses made while showing the loading screen
-    if isinstance(display_inport, aioserial.AioSerial):
-        display_inport.reset_input_buffer()
+        # We ignore any key presses made while showing the loading screen
+        if isinstance(display_inport, aioserial.AioSerial):
+            display_inport.reset_input_buffer()
+    finally:
+        loading = False
+
+def receive_midi(msg):
+    # Incoming MIDI is only of interest while waiting for GrandOrgue
+    if loading:
+        midi_in_queue.put_nowait(msg)
+
+def send_midi(msg):
+    midi_out_queue.put_nowait(msg)
+
+def midi_sender(loop):
+    # Runs on its own thread so slow MIDI output never blocks the event loop
+    try:
+        for msg in iter(midi_out_queue.get, None):
+            mdevice.send(msg)
+    except Exception as inst:
+        print('MIDI output failed:', repr(inst))
+        loop.call_soon_threadsafe(loop.stop)
 
 def chain_screens(screens):
     for i in range(1, len(screens)):
         screens[i - 1].adjacent[Key.RIGHT] = screens[i]
         screens[i].adjacent[Key.LEFT] = screens[i - 1]
 
+def write_user_settings(data):
+    # Write to a temporary file first, so an interrupted write can't
+    # truncate the existing settings
+    tmp_path = user_settings_path + '.tmp'
+    with open(tmp_path, 'w') as fd:
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_path, user_settings_path)
+
+def on_user_settings_written(fut):
+    if fut.exception() is not None:
+        print('Failed to save user settings:', fut.exception())
+
+def stops_to_mask(stops):
+    mask = 0
+    for stop in stops:
+        # Check before shifting, a huge note number would make a huge int
+        if not 0 <= stop < 128:
+            raise ValueError(f'{stop} is not a MIDI note')
+        mask |= 1 << stop
+    return mask
+
+def mask_to_stops(mask):
+    stops = []
+    while mask:
+        bit = mask & -mask
+        stops.append(bit.bit_length() - 1)
+        mask ^= bit
+    return stops
+
 def save_user_settings():
     pset = {}
     for pst, st in piston_settings.items():
-        pset[pst] = list(st)
+        pset[pst] = mask_to_stops(st)
     dump_me = {'piston_settings': pset}
-    with open(user_settings_path, 'wb') as fd:
-        tomli_w.dump(dump_me, fd)
+    data = json.dumps(dump_me, separators=(',', ':'))
+
+    # Don't stall the event loop on slow storage
+    loop = asyncio.get_running_loop()
+    fut = loop.run_in_executor(settings_writer, write_user_settings, data)
+    fut.add_done_callback(on_user_settings_written)
+
+class EventKind(IntEnum):
+    SLEEP = 0
+    KEY = 1
+    REG = 2
 
 class Key(Enum):
     LEFT = 1
@@ -113,7 +241,17 @@ class Key(Enum):
     UP = 3
     RIGHT = 4
 
+# State transitions for decoding arrow key escape sequences (ESC [ A-D);
+# the final state maps to the key that was pressed
+key_decoder = [
+    {0x1b: 1},
+    {0x5b: 2},
+    {0x41: Key.UP, 0x42: Key.DOWN, 0x43: Key.RIGHT, 0x44: Key.LEFT},
+]
+
 class Screen:
+    __slots__ = ('adjacent',)
+
     def __init__(self):
         self.adjacent = {}
 
@@ -124,20 +262,24 @@ class Screen:
             active_screen = new_screen
             active_screen.redraw()
 
-    def redraw(self):
-        pass
+    def render(self):
+        return format_frame(b'', b'')
 
-    def should_redraw(self):
-        return False
+    def redraw(self):
+        display_write_frame(self.render())
 
     def reset(self):
         pass
 
 class IntSelect(Screen):
-    active = False
+    __slots__ = (
+        'value', 'default', 'name', 'minimum', 'maximum', 'stride',
+        'unit_suffix', 'on_update', 'active',
+    )
 
     def __init__(self, name, default, minimum, maximum, stride=1, unit_suffix=''):
         super().__init__()
+        self.active = False
         self.value = default
         self.default = default
         self.name = name
@@ -173,19 +315,21 @@ class IntSelect(Screen):
     def format_option(self):
         return f'{self.value}{self.unit_suffix}'
 
-    def redraw(self):
+    def render(self):
         left = not self.active and (Key.LEFT in self.adjacent)
         right = not self.active and (Key.RIGHT in self.adjacent)
-        display_outport_writeln(format_arrows(self.name, left, right))
+        title = format_arrows(self.name, left, right)
 
         left = self.active and self.value > self.minimum
         right = self.active and self.value < self.maximum
-        display_outport_writeln(format_arrows(self.format_option(), left, right))
+        return format_frame(title, format_arrows(self.format_option(), left, right))
 
     def reset(self):
         self.value = self.default
 
 class EnumSelect(IntSelect):
+    __slots__ = ('options',)
+
     def __init__(self, name, options, default=0):
         super().__init__(name, default, 0, len(options) - 1)
         self.options = options
@@ -194,13 +338,14 @@ class EnumSelect(IntSelect):
         return self.options[self.value]
 
 class OnOffSelect(Screen):
-    active = False
+    __slots__ = ('name', 'on_text', 'off_text', 'on_msg', 'off_msg', 'active')
 
     def __init__(self, name, on_text, off_text, on_msg, off_msg):
         super().__init__()
+        self.active = False
         self.name = name
-        self.on_text = on_text
-        self.off_text = off_text
+        self.on_text = encode_text(on_text)
+        self.off_text = encode_text(off_text)
         self.on_msg = on_msg
         self.off_msg = off_msg
 
@@ -208,23 +353,27 @@ class OnOffSelect(Screen):
         if self.active:
             if key == Key.UP:
                 self.active = False
-                mdevice.send(self.off_msg)
+                send_midi(self.off_msg)
                 self.redraw()
         else:
             if key in (Key.LEFT, Key.RIGHT):
                 super().process_key(key)
             elif key == Key.DOWN:
                 self.active = True
-                mdevice.send(self.on_msg)
+                send_midi(self.on_msg)
                 self.redraw()
 
-    def redraw(self):
+    def render(self):
         left = not self.active and (Key.LEFT in self.adjacent)
         right = not self.active and (Key.RIGHT in self.adjacent)
-        display_outport_writeln(format_arrows(self.name, left, right))
-        display_outport_writeln(self.off_text if self.active else self.on_text)
+        return format_frame(
+            format_arrows(self.name, left, right),
+            self.off_text if self.active else self.on_text,
+        )
 
 class PistonSaveScreen(Screen):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__()
 
@@ -232,75 +381,99 @@ class PistonSaveScreen(Screen):
         return piston is not None and piston != manual_piston
 
     def process_key(self, key):
+        global stops_dirty
         if key in (Key.LEFT, Key.RIGHT):
             super().process_key(key)
         elif key == Key.DOWN and self.can_save():
-            piston_settings[piston] = selected_stops.copy()
-            print(piston_settings)
+            piston_settings[piston] = selected_stops
+            stops_dirty = True
+            if DEBUG:
+                print({p: mask_to_stops(m) for p, m in piston_settings.items()})
             save_user_settings()
             self.redraw()
 
-    def redraw(self):
+    def render(self):
         left = Key.LEFT in self.adjacent
         right = Key.RIGHT in self.adjacent
-        display_outport_writeln(format_arrows('Combinatie', left, right))
-        text = ''
+        title = format_arrows('Combinatie', left, right)
+        text = b''
         if self.can_save():
             saved = piston_settings.get(piston, None)
             if saved == selected_stops:
-                text = f'  {piston} opgeslagen'
+                text = encode_text(f'  {piston} opgeslagen')
             else:
-                text = f'  {piston} OPSLAAN?'
-        display_outport_writeln(text)
-
-    def should_redraw(self):
-        return True
+                text = encode_text(f'  {piston} OPSLAAN?')
+        return format_frame(title, text)
 
 
 async def read_arrow_keys(timeout):
     display_inport.timeout = timeout
+    state = 0
     while True:
-        full = b''
-        pattern = b'\x1b['
-        for _ in range(3):
-            s = await display_inport.read_async()
-            if s == b'':
-                # Timeout reached
-                await tty_queue.put(b'sleep\n')
-                break
-            full += s
-            if not pattern.startswith(full[:len(pattern)]):
-                break
-        else:
-            await tty_queue.put(full)
+        data = await display_inport.read_async(1)
+        if data and display_inport.in_waiting:
+            # Take the rest of the burst that has already arrived
+            data += display_inport.read(display_inport.in_waiting)
+        if data == b'':
+            # Timeout reached
+            state = 0
+            await tty_queue.put((EventKind.SLEEP, None))
+            continue
+
+        for byte in data:
+            next_state = key_decoder[state].get(byte)
+            if isinstance(next_state, Key):
+                await tty_queue.put((EventKind.KEY, next_state))
+                state = 0
+            elif next_state is None:
+                # Unexpected byte, which may still start a new sequence
+                state = key_decoder[0].get(byte, 0)
+            else:
+                state = next_state
 
 async def read_reg_lines():
+    pending = b''
     while True:
-        await tty_queue.put(await reg_inport.readline_async())
+        # Block for at least one byte, but take a whole burst when it's there
+        pending += await reg_inport.read_async(max(1, reg_inport.in_waiting))
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            await tty_queue.put((EventKind.REG, line))
 
-def update_stop_selection(cmd):
-    words = cmd.strip().split(' ')
-    if words[0] != 'stop':
-        raise ValueError()
+stop_command = re.compile(rb'stop( (on|off) [0-9]+(,[0-9]+)*)+')
+stop_group = re.compile(rb' (on|off) ([0-9,]+)')
 
-    if len(words) % 2 != 1:
+def update_stop_selection(cmd):
+    global selected_stops, stops_dirty
+    cmd = cmd.strip()
+    if not stop_command.fullmatch(cmd):
         raise ValueError()
 
-    for i in range(1, len(words), 2):
-        on_or_off = words[i]
-        stops = {int(s) for s in words[i + 1].split(',')}
-        if on_or_off == 'on':
-            selected_stops.update(stops)
-        elif on_or_off == 'off':
-            selected_stops.difference_update(stops)
+    # Only apply the command once every group has been parsed
+    selection = selected_stops
+    for m in stop_group.finditer(cmd):
+        stops = stops_to_mask(map(int, m.group(2).split(b',')))
+        if m.group(1) == b'on':
+            selection |= stops
         else:
-            raise ValueError()
+            selection &= ~stops
 
+    selected_stops = selection
+    stops_dirty = True
 
-def send_stops(prev_active_stops):
-    for stop in active_stops.symmetric_difference(prev_active_stops):
-        msg_type = 'note_on' if stop in active_stops else 'note_off'
-        mdevice.send(mido.Message(msg_type, note=stop, channel=stops_channel))
+
+def send_stops(stops):
+    global active_stops
+    changed = stops ^ active_stops
+    while changed:
+        bit = changed & -changed
+        stop = bit.bit_length() - 1
+        if stops & bit:
+            send_midi(stop_on_messages[stop])
+        else:
+            send_midi(stop_off_messages[stop])
+        changed ^= bit
+    active_stops = stops
 
 
 reset_on_reload = []
@@ -310,12 +483,28 @@ instruments = [
     'Positief',
 ]
 instrument = EnumSelect('Instrument', instruments)
-def on_instrument_update(value):
-    mdevice.send(AntonijnSysexEvent.INSTRUMENT.midi_message(value))
-    wait_for_ready()
+async def reload_instrument(value):
+    global active_stops
+    send_midi(AntonijnSysexEvent.INSTRUMENT.midi_message(value))
+    await wait_for_ready()
     for screen in reset_on_reload:
         screen.reset()
-    send_stops(set())
+
+    # Re-engage all active stops on the freshly loaded instrument
+    stops = active_stops
+    active_stops = 0
+    send_stops(stops)
+    active_screen.redraw()
+reload_task = None
+def on_instrument_update(value):
+    global loading, reload_task
+    if reload_task is not None and not reload_task.done():
+        # Only one reload at a time
+        return
+    # Set before the task runs, so key events already queued are ignored
+    loading = True
+    reload_task = asyncio.create_task(reload_instrument(value))
+    reload_task.add_done_callback(stop_on_failure)
 instrument.on_update = on_instrument_update
 
 temperaments = [
@@ -330,13 +519,13 @@ temperaments = [
     'Pyth. (B-F#)',
 ]
 temperament = EnumSelect('Stemming', temperaments, default=1)
-temperament.on_update = lambda value: mdevice.send(AntonijnSysexEvent.TEMPERAMENT.midi_message(value))
+temperament.on_update = lambda value: send_midi(AntonijnSysexEvent.TEMPERAMENT.midi_message(value))
 reset_on_reload.append(temperament)
 
 piston_save = PistonSaveScreen()
 
 transpose = IntSelect('Transpositie', 0, -11, 11)
-transpose.on_update = lambda value: mdevice.send(AntonijnSysexEvent.TRANSPOSE.midi_message(value))
+transpose.on_update = lambda value: send_midi(AntonijnSysexEvent.TRANSPOSE.midi_message(value))
 
 recorder = OnOffSelect(
     'Opname',
@@ -347,11 +536,11 @@ recorder = OnOffSelect(
 )
 
 met_bpm = IntSelect('Metron. BPM', 80, 1, 500)
-met_bpm.on_update = lambda value: mdevice.send(AntonijnSysexEvent.METRONOME_BPM.midi_message(value))
+met_bpm.on_update = lambda value: send_midi(AntonijnSysexEvent.METRONOME_BPM.midi_message(value))
 reset_on_reload.append(met_bpm)
 
 met_div = IntSelect('Metron. div.', 4, 0, 32)
-met_div.on_update = lambda value: mdevice.send(AntonijnSysexEvent.METRONOME_MEASURE.midi_message(value))
+met_div.on_update = lambda value: send_midi(AntonijnSysexEvent.METRONOME_MEASURE.midi_message(value))
 reset_on_reload.append(met_div)
 
 met = OnOffSelect(
@@ -365,7 +554,7 @@ met = OnOffSelect(
 chain_screens([instrument, temperament, piston_save, transpose, recorder, met_bpm, met_div, met])
 
 async def main():
-    global manual_piston, stops_channel
+    global manual_piston, stops_channel, stop_on_messages, stop_off_messages
 
     user_conf_dir = os.environ.get('XDG_CONFIG_HOME', os.path.join(os.getenv('HOME'), '.config'))
     app_conf_dir = os.path.join(user_conf_dir, 'johannus-control-panel')
@@ -379,6 +568,8 @@ async def main():
         midi_name = midi.get('name', 'Control Panel')
         print('Name:', midi_name)
         stops_channel = midi.get('stops_channel', 0)
+        stop_on_messages = [mido.Message('note_on', note=n, channel=stops_channel) for n in range(128)]
+        stop_off_messages = [mido.Message('note_off', note=n, channel=stops_channel) for n in range(128)]
 
         system = conf['system']
         display_tty = system.get('display_tty')
@@ -389,21 +580,36 @@ async def main():
 
         organ = conf['organ']
         manual_piston = organ.get('manual_piston_setting')
-        reed_stops = set(organ.get('reed_stops'))
+        reed_stops = stops_to_mask(organ.get('reed_stops'))
 
     global piston_settings, user_settings_path
 
-    user_settings_path = os.path.join(app_conf_dir, 'user-settings.toml')
+    user_settings_path = os.path.join(app_conf_dir, 'user-settings.json')
+    legacy_settings_path = os.path.join(app_conf_dir, 'user-settings.toml')
+    conf = None
     if os.path.exists(user_settings_path):
         with open(user_settings_path, 'rb') as fd:
+            conf = json.load(fd)
+    elif os.path.exists(legacy_settings_path):
+        # Settings saved by older versions; these are rewritten as JSON on
+        # the next save
+        with open(legacy_settings_path, 'rb') as fd:
             conf = tomllib.load(fd)
-            for pst, stps in conf['piston_settings'].items():
-                piston_settings[pst] = set(stps)
+
+    if conf is not None:
+        for pst, stps in conf['piston_settings'].items():
+            piston_settings[pst] = stops_to_mask(stps)
 
     global mdevice, display_outport, display_inport, reg_outport, reg_inport
-    global selected_stops, active_stops, active_screen, piston, reed_cutoff
+    global active_screen, piston, reed_cutoff, stops_dirty
 
-    mdevice = mido.open_ioport(midi_name, virtual=True)
+    loop = asyncio.get_running_loop()
+    mdevice = mido.open_ioport(
+        midi_name,
+        virtual=True,
+        callback=lambda msg: loop.call_soon_threadsafe(receive_midi, msg),
+    )
+    threading.Thread(target=midi_sender, args=(loop,), daemon=True).start()
 
     display_outport = aioserial.AioSerial(display_tty)
     display_inport = display_outport
@@ -411,67 +617,70 @@ async def main():
     reg_outport = aioserial.AioSerial(reg_tty)
     reg_inport = reg_outport
 
-    wait_for_ready()
-    send_stops(set())
+    display_task = asyncio.create_task(write_display())
+    display_task.add_done_callback(stop_on_failure)
+
+    await wait_for_ready()
 
     asyncio.create_task(read_arrow_keys(blank_after))
     asyncio.create_task(read_reg_lines())
 
     screen_asleep = False
 
-    keymap = {
-        '\x1b[A': Key.UP,
-        '\x1b[B': Key.DOWN,
-        '\x1b[C': Key.RIGHT,
-        '\x1b[D': Key.LEFT,
-    }
-
     active_screen = instrument
     active_screen.redraw()
     while True:
-        cmd = await tty_queue.get()
-        cmd = cmd.decode(errors='ignore')
-        if cmd == 'sleep\n':
+        kind, payload = await tty_queue.get()
+        if loading and kind != EventKind.REG:
+            # Display belongs to the loading screen until ready
+            pass
+        elif kind == EventKind.SLEEP:
             # Waiting mode
             # Clear display
-            display_outport_writeln('')
-            display_outport_writeln('')
+            display_write_frame(format_frame(b'', b''))
             screen_asleep = True
-        elif cmd in keymap:
+        elif kind == EventKind.KEY:
             if screen_asleep:
                 active_screen.redraw()
                 screen_asleep = False
             else:
-                active_screen.process_key(keymap[cmd])
-        else:
-            print('Got command', repr(cmd))
+                active_screen.process_key(payload)
+        elif kind == EventKind.REG:
+            cmd = payload
+            if DEBUG:
+                print('Got command', repr(cmd))
 
             try:
-                if cmd.startswith('stop '):
+                if cmd.startswith(b'stop '):
                     update_stop_selection(cmd)
-                elif cmd.startswith('piston '):
-                    piston = cmd[7:].strip()
-                elif cmd == 'reeds on\n':
+                elif cmd.startswith(b'piston '):
+                    piston = cmd[7:].strip().decode(errors='ignore')
+                    stops_dirty = True
+                elif cmd == b'reeds on':
                     reed_cutoff = False
-                elif cmd == 'reeds off\n':
+                    stops_dirty = True
+                elif cmd == b'reeds off':
                     reed_cutoff = True
+                    stops_dirty = True
             except Exception as inst:
                 print(inst)
 
-        prev_active_stops = active_stops.copy()
+        if stops_dirty:
+            stops_dirty = False
 
-        if piston == manual_piston or piston not in piston_settings:
-            active_stops = selected_stops.copy()
-        else:
-            active_stops = piston_settings[piston].copy()
+            if piston == manual_piston or piston not in piston_settings:
+                stops = selected_stops
+            else:
+                stops = piston_settings[piston]
 
-        if reed_cutoff:
-            active_stops.difference_update(reed_stops)
+            if reed_cutoff:
+                stops &= ~reed_stops
 
-        send_stops(prev_active_stops)
+            send_stops(stops)
 
-        if not screen_asleep and active_screen.should_redraw():
-            active_screen.redraw()
+            # The piston save screen shows whether the selection is saved
+            if not screen_asleep and active_screen is piston_save:
+                piston_save.redraw()
 
 if __name__ == "__main__":
     asyncio.run(main())